@@ -24,7 +24,12 @@ from pox.core import core
 import pox.openflow.libopenflow_01 as of
 from pox.lib.util import dpid_to_str
 from pox.lib.util import str_to_bool
-from pox.lib.addresses import IPAddr
+from pox.lib.addresses import IPAddr, EthAddr, parse_cidr
+import pox.openflow.nicira as nx
+import json
+import queue
+import socket
+import threading
 import time
 
 # constants
@@ -32,12 +37,55 @@ DROP_DURATION = 10
 IDLE_TIMEOUT = 10
 HARD_TIMEOUT = 30
 
+# Replication heartbeat, and how long the standby waits without hearing
+# anything from the primary before taking over
+HEARTBEAT_INTERVAL = 0.2
+FAILOVER_TIMEOUT = 0.6
+
 log = core.getLogger()
 
 # We don't want to flood immediately when a switch connects.
 # Can be overriden on commandline.
 _flood_delay = 0
 
+# The firewall's inside network.  Can be overriden on commandline.
+_inside_network = IPAddr("192.168.1.0")
+_inside_subnet = 24
+
+class SendBuffer (object):
+  """
+  Coalesces the OpenFlow messages for a single connection.
+
+  Messages queued with send() are packed and held until the end of the
+  current event-loop tick, then written to the switch in one go.  The
+  switch is free to process a batch in any order; a caller that needs
+  everything queued so far handled before msg passes barrier=True.
+  """
+
+  def __init__ (self, connection):
+    self.connection = connection
+    self._pending = []
+    self._flush_scheduled = False
+
+  def send (self, msg, barrier = False):
+    """ Queues msg to go out with the rest of this tick's messages """
+    if barrier and self._pending:
+      self._pending.append(of.ofp_barrier_request().pack())
+    self._pending.append(msg.pack())
+    if not self._flush_scheduled:
+      self._flush_scheduled = True
+      core.callLater(self.flush)
+
+  def flush (self):
+    """ Writes everything queued so far with a single send """
+    self._flush_scheduled = False
+    if not self._pending: return
+    data = b''.join(self._pending)
+    self._pending = []
+    if self.connection.disconnected: return
+    self.connection.send(data)
+
+
 class LearningSwitch (object):
   """
   The learning switch "brain" associated with a single OpenFlow switch.
@@ -56,18 +104,25 @@ class LearningSwitch (object):
   this is bad!).
   """
 
-  def __init__ (self, connection, transparent):
+  def __init__ (self, connection, transparent, macToPort = None,
+                connections = None, replicator = None):
     # Switch we'll be adding L2 learning switch capabilities to
     self.connection = connection
     self.transparent = transparent
 
-    # Our table
-    self.macToPort = {}
-    self.connections = {}
+    # Streams our table changes to a standby controller, if any
+    self.replicator = replicator
+
+    # Everything we send goes through here so it can be batched
+    self.buffer = SendBuffer(connection)
+
+    # Our table (possibly already warmed up by replication)
+    self.macToPort = {} if macToPort is None else macToPort
+    self.connections = {} if connections is None else connections
 
     # Define firewall rule parameters
-    self.inside_network = IPAddr("192.168.1.0")  # Inside network IP address
-    self.inside_subnet = 24  # Inside network subnet mask
+    self.inside_network = _inside_network  # Inside network IP address
+    self.inside_subnet = _inside_subnet  # Inside network subnet mask
 
     # We want to hear PacketIn messages, so we listen
     # to the connection
@@ -76,6 +131,10 @@ class LearningSwitch (object):
     # We just use this to know when to log a helpful message
     self.hold_down_expired = _flood_delay == 0
 
+  def _replicate (self, kind, key, value = None):
+    if self.replicator is not None:
+      self.replicator.publish([self.connection.dpid, kind, key, value])
+
   def print_connections(self):
     # Print active connections
     out = "\nActive connections:\n"
@@ -86,12 +145,14 @@ class LearningSwitch (object):
   def add_connection(self, conn_str):
     # Add connection to the dictionary
     self.connections[conn_str] = time.time()
+    self._replicate("conn", conn_str, self.connections[conn_str])
     self.print_connections()
   
   def remove_connection(self, conn_str):
     # Remove connection from the dictionary
     if conn_str in self.connections:
       del self.connections[conn_str]
+      self._replicate("unconn", conn_str)
     self.print_connections()
 
   def is_established(self, conn_str):
@@ -105,6 +166,10 @@ class LearningSwitch (object):
     Handle packet in messages from the switch to implement above algorithm.
     """
 
+    if self.replicator is not None and not self.replicator.active:
+      # We're the standby; the primary is handling this switch
+      return
+
     packet = event.parsed
     # Extract IP layer from the packet
     ip_packet = packet.find('ipv4')
@@ -131,7 +196,7 @@ class LearningSwitch (object):
         #log.info("Holding down flood for %s", dpid_to_str(event.dpid))
       msg.data = event.ofp
       msg.in_port = event.port
-      self.connection.send(msg)
+      self.buffer.send(msg)
 
     def drop (duration = None):
       """
@@ -146,14 +211,16 @@ class LearningSwitch (object):
         msg.idle_timeout = duration[0]
         msg.hard_timeout = duration[1]
         msg.buffer_id = event.ofp.buffer_id
-        self.connection.send(msg)
+        self.buffer.send(msg)
       elif event.ofp.buffer_id is not None:
         msg = of.ofp_packet_out()
         msg.buffer_id = event.ofp.buffer_id
         msg.in_port = event.port
-        self.connection.send(msg)
+        self.buffer.send(msg)
 
-    self.macToPort[packet.src] = event.port # 1
+    if self.macToPort.get(packet.src) != event.port: # 1
+      self.macToPort[packet.src] = event.port
+      self._replicate("mac", str(packet.src), event.port)
 
     if not self.transparent: # 2
       if packet.type == packet.LLDP_TYPE or packet.dst.isBridgeFiltered():
@@ -238,25 +305,298 @@ class LearningSwitch (object):
         msg.actions.append(of.ofp_action_output(port = port))
         msg.data = event.ofp
         # 6a) Send the packet out appropriate port
-        self.connection.send(msg)
+        self.buffer.send(msg)
+
+
+class StateReplicator (object):
+  """
+  Keeps a standby controller's tables in step with the primary's.
+
+  The primary listens on a local TCP socket.  When the standby connects
+  it is sent a snapshot of every switch's MAC and connection tables,
+  followed by a stream of deltas as they happen (one JSON list per
+  line), with heartbeats in between.  The standby applies these to its
+  own tables, so when it stops hearing from the primary it can become
+  master for the switches straight away with warm tables instead of
+  re-learning everything.
+
+  Nobody is master until they hold the replication socket.  A primary
+  that starts up while another controller already answers there (say,
+  the standby that took over while it was down) follows that one
+  instead of claiming the switches with empty tables.
+
+  Each takeover bumps a generation number.  The new master tells the
+  old one to step down by connecting to its socket with a "demote"
+  carrying the new generation, and a primary that gets one with a
+  newer generation (or is refused by a switch for no longer being
+  master) drops to standby and follows the new master instead.
+
+  Socket I/O happens on helper threads; anything touching the tables is
+  handed back to the cooperative thread with core.callLater().
+  """
+
+  def __init__ (self, owner, standby, address):
+    self.owner = owner
+    self.active = False
+    self.address = address
+    self.generation = 0
+    self._queue = None
+
+    if standby:
+      self._start(self._follow)
+    else:
+      self._start(self._claim)
+
+  def _start (self, target, *args):
+    t = threading.Thread(target = target, args = args)
+    t.daemon = True
+    t.start()
+
+  def publish (self, delta):
+    """ Sends a table change to the standby, if one is listening """
+    q = self._queue
+    if q is not None:
+      q.put(delta)
+
+  def _claim (self):
+    """ Primary: become master, unless someone else already is """
+    try:
+      sock = socket.create_connection(self.address, FAILOVER_TIMEOUT)
+    except OSError:
+      self._serve()
+      return
+    sock.close()
+    log.warning("A master is already replicating on %s:%s -- "
+                "starting as standby", *self.address)
+    self._follow()
+
+  def _serve (self):
+    """ Take the replication socket, become master and serve standbys """
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    warned = False
+    while True:
+      try:
+        listener.bind(self.address)
+        break
+      except OSError as e:
+        # Normally the old master, until it has stepped down
+        if not warned:
+          log.warning("Can't replicate on %s:%s yet (%s) -- retrying",
+                      self.address[0], self.address[1], e)
+          warned = True
+        time.sleep(HEARTBEAT_INTERVAL)
+    listener.listen(4)
+    # Wake up now and then to notice if we've stepped down
+    listener.settimeout(HEARTBEAT_INTERVAL)
+    log.info("Replicating state on %s:%s", *self.address)
+    self.active = True
+    core.callLater(self.owner.become_master)
+    while self.active:
+      try:
+        sock, addr = listener.accept()
+      except socket.timeout:
+        continue
+      self._start(self._peer, sock, addr)
+    listener.close()
+
+  def _peer (self, sock, addr):
+    sock.settimeout(FAILOVER_TIMEOUT)
+    try:
+      hello = json.loads(sock.makefile("r").readline())
+    except (OSError, ValueError):
+      sock.close()
+      return
+
+    if hello[0] == "demote":
+      sock.close()
+      if hello[1] > self.generation:
+        core.callLater(self.step_down, hello[1])
+      return
+
+    if not self.active:
+      sock.close()
+      return
+    sock.settimeout(None)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    log.info("Standby connected from %s:%s", *addr)
+    q = queue.Queue()
+    self._queue = q
+    core.callLater(lambda: q.put(["reset", self.owner.snapshot(),
+                                  self.generation]))
+    self._stream(sock, q)
+    if self._queue is q:
+      self._queue = None
+    log.warning("Standby disconnected")
+
+  def _stream (self, sock, q):
+    while self._queue is q and self.active:
+      try:
+        deltas = [q.get(timeout = HEARTBEAT_INTERVAL)]
+        while not q.empty():
+          deltas.append(q.get_nowait())
+      except queue.Empty:
+        deltas = [["beat"]]
+      data = "".join(json.dumps(d) + "\n" for d in deltas)
+      try:
+        sock.sendall(data.encode())
+      except OSError:
+        break
+    sock.close()
+
+  def _follow (self):
+    """ Standby: mirror the master until it goes quiet, then take over """
+    synced = False
+    while not synced:
+      try:
+        sock = socket.create_connection(self.address)
+        sock.sendall(b'["follow"]\n')
+      except OSError:
+        time.sleep(HEARTBEAT_INTERVAL)
+        continue
+      log.info("Following master at %s:%s", *self.address)
+      sock.settimeout(FAILOVER_TIMEOUT)
+      stream = sock.makefile("r")
+      try:
+        for line in stream:
+          delta = json.loads(line)
+          if delta[0] == "beat": continue
+          if delta[0] == "reset":
+            self.generation = max(self.generation, delta[2])
+          synced = True
+          core.callLater(self.owner.apply, [delta])
+      except (OSError, ValueError):
+        pass
+      sock.close()
+
+    core.callLater(self._take_over)
+
+  def _take_over (self):
+    if self.active: return
+    self.generation += 1
+    log.warning("Master lost -- taking over with warm tables (generation %s)",
+                self.generation)
+    self._start(self._demote)
+    # Becomes master as soon as the old one lets go of the socket
+    self._start(self._serve)
+
+  def _demote (self):
+    """ Tells a still-running old master to step down """
+    try:
+      sock = socket.create_connection(self.address, FAILOVER_TIMEOUT)
+      sock.sendall((json.dumps(["demote", self.generation]) + "\n").encode())
+      sock.close()
+    except OSError:
+      pass # Nobody there; it's really gone
+
+  def step_down (self, generation = None):
+    """ Stops acting as master and follows whoever took over """
+    if not self.active: return
+    if generation is not None:
+      self.generation = max(self.generation, generation)
+    log.warning("Lost master role -- stepping down to standby")
+    self.active = False
+    self._queue = None
+    self.owner.become_slave()
+    self._start(self._follow)
 
 
 class l2_learning (object):
   """
   Waits for OpenFlow switches to connect and makes them learning switches.
+
+  When replicating, each switch's tables are kept here, keyed by DPID,
+  so that they can be filled in by replication and survive the switch
+  reconnecting.
   """
-  def __init__ (self, transparent):
+  def __init__ (self, transparent, role = None, address = None):
     core.openflow.addListeners(self)
     self.transparent = transparent
+    self.tables = {}
+    self.switches = {}
+
+    self.replicator = None
+    if role is not None:
+      self.replicator = StateReplicator(self, role == "standby", address)
+
+  def _tables (self, dpid):
+    return self.tables.setdefault(dpid, ({}, {}))
+
+  def snapshot (self):
+    """ All tables, in a form that can be sent to the standby """
+    return dict((str(dpid), {"macs" : dict((str(mac), port)
+                                           for mac, port in macs.items()),
+                             "conns" : dict(conns)})
+                for dpid, (macs, conns) in self.tables.items())
+
+  def apply (self, deltas):
+    """ Applies deltas received from the primary to our tables """
+    for delta in deltas:
+      if delta[0] == "reset":
+        for dpid, t in delta[1].items():
+          macs, conns = self._tables(int(dpid))
+          macs.clear()
+          macs.update((EthAddr(mac), port) for mac, port in t["macs"].items())
+          conns.clear()
+          conns.update(t["conns"])
+        continue
+      dpid, kind, key, value = delta
+      macs, conns = self._tables(dpid)
+      if kind == "mac":
+        macs[EthAddr(key)] = value
+      elif kind == "conn":
+        conns[key] = value
+      elif kind == "unconn":
+        conns.pop(key, None)
+
+  def _send_role (self, switch, master):
+    # Anything already queued went out under the old role, so it has to
+    # be handled before the switch sees the change
+    switch.buffer.send(nx.nx_role_request(master = master, slave = not master),
+                       barrier = True)
+
+  def become_master (self):
+    for switch in self.switches.values():
+      self._send_role(switch, True)
+
+  def become_slave (self):
+    for switch in self.switches.values():
+      self._send_role(switch, False)
+
+  def _handle_ErrorIn (self, event):
+    # A switch refusing our changes means another controller is master
+    if (self.replicator is not None and self.replicator.active
+        and event.ofp.type == of.OFPET_BAD_REQUEST
+        and event.ofp.code == of.OFPBRC_EPERM):
+      self.replicator.step_down()
 
   def _handle_ConnectionUp (self, event):
     log.debug("Connection %s" % (event.connection,))
-    LearningSwitch(event.connection, self.transparent)
-
-
-def launch (transparent=False, hold_down=_flood_delay):
+    if self.replicator is not None:
+      macToPort, connections = self._tables(event.dpid)
+      switch = LearningSwitch(event.connection, self.transparent, macToPort,
+                              connections, self.replicator)
+      self.switches[event.dpid] = switch
+      self._send_role(switch, self.replicator.active)
+    else:
+      LearningSwitch(event.connection, self.transparent)
+
+  def _handle_ConnectionDown (self, event):
+    switch = self.switches.get(event.dpid)
+    if switch is not None and switch.connection is event.connection:
+      del self.switches[event.dpid]
+
+
+def launch (transparent=False, hold_down=_flood_delay, role=None,
+            replicate="127.0.0.1:7790", inside="192.168.1.0/24"):
   """
   Starts an L2 learning switch.
+
+  --inside sets the network the firewall protects (default
+  192.168.1.0/24).
+
+  With --role=primary or --role=standby, tables are replicated from the
+  primary to the standby over the --replicate address.
   """
   try:
     global _flood_delay
@@ -265,5 +605,16 @@ def launch (transparent=False, hold_down=_flood_delay):
   except:
     raise RuntimeError("Expected hold-down to be a number")
 
-  core.registerNew(l2_learning, str_to_bool(transparent))
+  try:
+    global _inside_network, _inside_subnet
+    _inside_network, _inside_subnet = parse_cidr(inside)
+  except:
+    raise RuntimeError("Expected inside to be a network like 192.168.1.0/24")
+
+  if role not in (None, "primary", "standby"):
+    raise RuntimeError("Expected role to be primary or standby")
+  host, port = replicate.rsplit(":", 1)
+
+  core.registerNew(l2_learning, str_to_bool(transparent), role,
+                   (host, int(port)))
 
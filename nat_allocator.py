@@ -0,0 +1,178 @@
+"""
+Port block allocation for the NAT in nat_template.py.
+
+Kept apart from the Ryu app so it can be used and tested on its own.
+"""
+from collections import namedtuple, deque
+import time
+
+Ipv4_addr = namedtuple("Ipv4_addr", ["addr", "port"])
+
+# Protocols that get port translation
+NAT_PROTOS = (6, 17)
+
+# Seconds a translation may sit idle, per protocol, and how long a TCP
+# one is kept after a FIN (an RST frees it at once)
+IDLE_TIMEOUTS = {6: 300, 17: 60}
+CLOSING_TIMEOUT = 10
+
+# TCP flag bits
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+
+class PortBlockAllocator(object):
+    """
+    Hands out external (ip, port) pairs from a pool of addresses.
+
+    The ports of every external address are split into blocks of
+    BLOCK_SIZE and each inside host is given whole blocks, all from the
+    same external address while it has blocks left.  New hosts are
+    spread over the pool in turn.  TCP and UDP use the ports of a
+    host's blocks independently, and a host only gets another block
+    once a protocol has used up all the ones it has.
+
+    Translations are kept in two dicts, one per direction, so lookups
+    either way are O(1):
+        forward[(proto, inside ip, inside port)] = [ex ip, ex port,
+                                                    deadline, closing]
+        reverse[(ex ip, proto, ex port)] = Ipv4_addr(inside ip, inside port)
+
+    Every use pushes a translation's deadline back; expire() frees the
+    ones past it, and gives blocks left empty back to the pool.
+    """
+
+    def __init__(self, ex_ips, ex_ports, block_size):
+        self.pool = list(ex_ips)
+        self.ex_ips = frozenset(ex_ips)
+        self.first_port = ex_ports[0]
+        self.block_end = ex_ports[-1] + 1
+        self.block_size = block_size
+        self.free_blocks = dict((ip, deque(range(self.first_port, self.block_end,
+                                                 block_size)))
+                                for ip in ex_ips)
+        self._next_ip = 0
+        # inside ip -> {"blocks": {(ex ip, start): ports in use},
+        #               "free": {proto: deque of free (ex ip, port)}}
+        self.hosts = {}
+        self.forward = {}
+        self.reverse = {}
+
+    def translate(self, proto, addr, flags=0, now=None):
+        """
+        External (ip, port) for inside addr, allocating if needed.
+
+        Returns None if the pool is exhausted.  flags are the TCP flags
+        of the outbound packet being translated (0 for UDP).
+        """
+        key = (proto, addr.addr, addr.port)
+        entry = self.forward.get(key)
+        if entry is None:
+            host = self.hosts.get(addr.addr)
+            if host is None:
+                host = {"blocks": {}, "free": dict((p, deque()) for p in NAT_PROTOS)}
+                self.hosts[addr.addr] = host
+            free = host["free"][proto]
+            if not free and not self._add_block(host):
+                if not host["blocks"]:
+                    del self.hosts[addr.addr]
+                return None
+            ex_ip, port = free.popleft()
+            host["blocks"][self._block_of(ex_ip, port)] += 1
+            entry = [ex_ip, port, 0, False]
+            self.forward[key] = entry
+            self.reverse[(ex_ip, proto, port)] = addr
+        self._touch(entry, proto, flags, now)
+        return entry[0], entry[1]
+
+    def lookup(self, ex_ip, proto, port, now=None):
+        """
+        Inside Ipv4_addr for an external (ip, proto, port), or None.
+
+        Inbound packets keep a translation alive but never close it; the
+        key doesn't say who sent them, so any outside host could.
+        """
+        addr = self.reverse.get((ex_ip, proto, port))
+        if addr is not None:
+            self._touch(self.forward[(proto, addr.addr, addr.port)], proto,
+                        0, now)
+        return addr
+
+    def expire(self, now=None):
+        """ Frees every translation past its deadline; returns how many """
+        if now is None:
+            now = time.time()
+        expired = [key for key, entry in self.forward.items() if entry[2] <= now]
+        for key in expired:
+            self.release(key)
+        return len(expired)
+
+    def release(self, key):
+        """ Frees the translation for (proto, inside ip, inside port) """
+        proto, in_ip, _ = key
+        ex_ip, port, _, _ = self.forward.pop(key)
+        del self.reverse[(ex_ip, proto, port)]
+
+        host = self.hosts[in_ip]
+        block = self._block_of(ex_ip, port)
+        host["free"][proto].append((ex_ip, port))
+        host["blocks"][block] -= 1
+        if host["blocks"][block]:
+            return
+
+        # Block is empty: take its ports back and return it to the pool
+        del host["blocks"][block]
+        for p in NAT_PROTOS:
+            host["free"][p] = deque(a for a in host["free"][p]
+                                    if self._block_of(*a) != block)
+        self.free_blocks[block[0]].append(block[1])
+        if not host["blocks"]:
+            del self.hosts[in_ip]
+
+    def _touch(self, entry, proto, flags, now):
+        if now is None:
+            now = time.time()
+        if flags & TCP_RST:
+            entry[2] = now
+            entry[3] = True
+        elif entry[3] and flags & TCP_SYN and not flags & TCP_ACK:
+            # A new connection reusing the same inside ip:port
+            entry[2] = now + IDLE_TIMEOUTS[proto]
+            entry[3] = False
+        elif entry[3]:
+            pass # Already closing; don't keep it alive
+        elif flags & TCP_FIN:
+            entry[2] = now + CLOSING_TIMEOUT
+            entry[3] = True
+        else:
+            entry[2] = now + IDLE_TIMEOUTS[proto]
+
+    def _block_of(self, ex_ip, port):
+        offset = (port - self.first_port) // self.block_size * self.block_size
+        return (ex_ip, self.first_port + offset)
+
+    def _add_block(self, host):
+        """ Gives host another block; False if the pool is exhausted """
+        ex_ip = self._pick_ip(host)
+        if ex_ip is None:
+            return False
+        start = self.free_blocks[ex_ip].popleft()
+        host["blocks"][(ex_ip, start)] = 0
+        ports = range(start, min(start + self.block_size, self.block_end))
+        for p in NAT_PROTOS:
+            host["free"][p].extend((ex_ip, port) for port in ports)
+        return True
+
+    def _pick_ip(self, host):
+        # Stay on an address the host already uses, if it has room
+        for ex_ip, _ in host["blocks"]:
+            if self.free_blocks[ex_ip]:
+                return ex_ip
+        # Otherwise the next address in the pool with a free block
+        for i in range(len(self.pool)):
+            ex_ip = self.pool[(self._next_ip + i) % len(self.pool)]
+            if self.free_blocks[ex_ip]:
+                self._next_ip = (self._next_ip + i + 1) % len(self.pool)
+                return ex_ip
+        return None
@@ -57,22 +57,33 @@ from ryu.lib.packet import tcp
 from ryu.lib.packet import udp 
 from ryu.lib.packet import icmp
 from ryu.controller import dpset
+from ryu.lib import hub
 from netaddr import *
-from collections import namedtuple
+from nat_allocator import Ipv4_addr, PortBlockAllocator
+
+# External addresses to translate to, and the ports used on each of them
+EX_IPS = ["128.128.129.1"]
+EX_PORTS = range(50000, 60000)
+# Each inside host gets ports handed out in blocks of this size
+BLOCK_SIZE = 64
+# How often expired translations are swept up
+SWEEP_INTERVAL = 5
 
 class NAT(app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_0.OFP_VERSION]
-    global Ipv4_addr 
-    Ipv4_addr = namedtuple("Ipv4_addr", ["addr", "port"])    
 
     def __init__(self, *args, **kwargs):
         super(NAT, self).__init__(*args, **kwargs)
-    global ex_ip
-    ex_ip = "128.128.129.1"
-    global maps
-    maps = {}
-    global ports
-    ports = range(50000,60000)
+        self.nat = PortBlockAllocator(EX_IPS, EX_PORTS, BLOCK_SIZE)
+        self.expire_thread = hub.spawn(self._expire)
+
+    def _expire(self):
+        while True:
+            hub.sleep(SWEEP_INTERVAL)
+            expired = self.nat.expire()
+            if expired:
+                self.logger.debug("Expired %d NAT translations", expired)
+
     def add_flow(self, datapath, match, actions, priority=0, hard_timeout=0):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
@@ -146,7 +157,6 @@ class NAT(app_manager.RyuApp):
 
         bitmask = "24"
         src_match = IPNetwork("192.168.0.0"+ "/" + bitmask)
-        dst_match = ex_ip
 
         if message.in_port == ofproto.OFPP_LOCAL :
             out_port = 1
@@ -165,42 +175,38 @@ class NAT(app_manager.RyuApp):
                 src_port = t.src_port if t else u.src_port
                 ip_addr = Ipv4_addr(addr=ip.src , port=src_port)
 
-                if ip_addr in maps: port = maps[ip_addr]
-                else:
-                    port = ports.pop(0)
-                    maps[ip_addr] = port
-                    maps[port] = ip_addr
+                translated = self.nat.translate(ip.proto, ip_addr, t.bits if t else 0)
+                if translated is None:
+                    self.logger.warn("NAT port pool exhausted, dropping %s:%s", ip.src, src_port)
+                    return
+                ex_ip, port = translated
                 
                 actions =[parser.OFPActionSetNwSrc(self.ipv4_to_int(ex_ip)),parser.OFPActionSetTpSrc(port),parser.OFPActionOutput(out_port)]
             
                 out = parser.OFPPacketOut(datapath=datapath, buffer_id=message.buffer_id, data=message.data, in_port=message.in_port,actions=actions)
                 datapath.send_msg(out)
                 return
-        elif ip.dst  == dst_match :
-            #print "convert dst"
-            dst_port = t.dst_port if t else u.dst_port
-            #print dst_port
-            
+
             #Route TCP and UDP packets that return from server here
-            if dst_port in maps:
-                dst_ip = maps[dst_port].addr
-                dst_port = maps[dst_port].port
-                #print dst_ip
-                #print dst_port
-            else:
-                self.logger.warn("No mapping found for %s", dst_port) 
-                return
+            if ip.dst in self.nat.ex_ips:
+                dst_port = t.dst_port if t else u.dst_port
+                ip_addr = self.nat.lookup(ip.dst, ip.proto, dst_port)
+                if ip_addr is None:
+                    self.logger.warn("No mapping found for %s:%s", ip.dst, dst_port)
+                    return
             
-            actions = [parser.OFPActionSetNwDst( self.ipv4_to_int(dst_ip) ),parser.OFPActionSetTpDst(dst_port),parser.OFPActionOutput(out_port)]
-            out = parser.OFPPacketOut(datapath=datapath, buffer_id=message.buffer_id, data=message.data, in_port=message.in_port,actions=actions)
-            datapath.send_msg(out)
+                actions = [parser.OFPActionSetNwDst( self.ipv4_to_int(ip_addr.addr) ),parser.OFPActionSetTpDst(ip_addr.port),parser.OFPActionOutput(out_port)]
+                out = parser.OFPPacketOut(datapath=datapath, buffer_id=message.buffer_id, data=message.data, in_port=message.in_port,actions=actions)
+                datapath.send_msg(out)
+                return
+
+            # Neither from the inside nor back to a NAT address: drop
             return
 
-        else:
-            #print "other"
-            actions = [parser.OFPActionOutput(out_port)]
-            out = parser.OFPPacketOut(datapath=datapath, buffer_id=message.buffer_id, data=message.data, in_port=message.in_port,actions=actions)
-            datapath.send_msg(out)		
+        #print "other"
+        actions = [parser.OFPActionOutput(out_port)]
+        out = parser.OFPPacketOut(datapath=datapath, buffer_id=message.buffer_id, data=message.data, in_port=message.in_port,actions=actions)
+        datapath.send_msg(out)
 
     def ipv4_to_str(self, integre):
         ip_list = [str((integre >> (24 - (n * 8)) & 255)) for n in range(4)]
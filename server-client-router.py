@@ -23,6 +23,13 @@ as 'defaultRoute' parameters for the host interfaces.
 
 Additional routes may be added to the router or hosts by
 executing 'ip route' or 'route' commands on the router or hosts.
+
+Both switches connect to two POX controllers, a primary (c1, port
+6633) and a hot standby (c2, port 6634) that takes over with warm
+tables if the primary goes away.  Start them first with e.g.:
+
+    ./pox.py openflow.of_01 --port=6633 learningswitch --role=primary
+    ./pox.py openflow.of_01 --port=6634 learningswitch --role=standby
 """
 
 from mininet.topo import Topo
@@ -53,9 +60,9 @@ def multiControllerNet():
     net = Mininet( controller=Controller, switch=OVSSwitch,
                    waitConnected=True )
 
-    info( "*** Creating (reference) controllers\n" )
+    info( "*** Creating primary and standby controllers\n" )
     c1 = net.addController('c1', controller=RemoteController, ip='127.0.0.1', protocol='tcp', port=6633)
-    c2 = net.addController('c2')
+    c2 = net.addController('c2', controller=RemoteController, ip='127.0.0.1', protocol='tcp', port=6634)
 
 
     info( "*** Creating router\n" )
@@ -91,8 +98,8 @@ def multiControllerNet():
     net.build()
     c1.start()
     c2.start()
-    s1.start( [ c1 ] )
-    s2.start( [ c2 ] )
+    s1.start( [ c1, c2 ] )
+    s2.start( [ c1, c2 ] )
 
     info( "*** Running CLI\n" )
     CLI( net )
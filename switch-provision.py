@@ -0,0 +1,188 @@
+#!/usr/bin/python
+
+"""
+Declarative Open vSwitch provisioning
+
+Reads a JSON spec of bridges and brings the local switch in line with
+it, touching only what differs from the current state:
+
+    {
+      "absent": [ "s3" ],
+      "bridges": {
+        "OVS2": {
+          "ports": [ "s3-eth1" ],
+          "ip": [ "192.168.0.1/24" ],
+          "controller": [ "tcp:127.0.0.1:6653" ],
+          "protocols": [ "OpenFlow10", "OpenFlow14" ],
+          "flows": [ "in_port=1,actions=LOCAL" ]
+        }
+      }
+    }
+
+Bridges listed in "absent" are deleted, and every bridge/port/controller
+change is made in a single ovs-vsctl transaction.  Bridges not
+mentioned at all are left alone.  Each key of a bridge is managed only
+if it is present: a listed key is made to match exactly (so "[]"
+removes all ports, addresses, controllers or flows), while a missing
+one is left as it is (e.g. "flows" on a bridge whose flows belong to
+the controller).
+
+Flows are compared with 'ovs-ofctl diff-flows' and, when they differ,
+swapped in with 'ovs-ofctl --bundle replace-flows', which only sends
+the flows that changed and applies them atomically.  Bundles need
+OpenFlow14, so such bridges should list it under "protocols".
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+
+BUNDLE_PROTOCOL = 'OpenFlow14'
+
+def sh( *cmd ):
+    "Run cmd and return its stdout"
+    return subprocess.run( cmd, check=True, stdout=subprocess.PIPE,
+                           universal_newlines=True ).stdout
+
+def lines( out ):
+    return [ l.strip() for l in out.splitlines() if l.strip() ]
+
+def currentBridge( name ):
+    "Current ports, addresses, controllers and protocols of a bridge"
+    addrs = []
+    for l in lines( sh( 'ip', '-4', '-o', 'addr', 'show', 'dev', name ) ):
+        addrs.append( l.split()[ 3 ] )
+    return dict( ports=lines( sh( 'ovs-vsctl', 'list-ports', name ) ),
+                 ip=addrs,
+                 controller=lines( sh( 'ovs-vsctl', 'get-controller', name ) ),
+                 protocols=json.loads( sh( 'ovs-vsctl', 'get', 'bridge', name,
+                                           'protocols' ) ) )
+
+def plan( spec ):
+    """
+    Work out what needs to change.
+
+    Returns the ovs-vsctl transaction (a list of commands), the ip
+    commands to run afterwards, the bridges whose flows are managed and
+    the bridges that can't be diffed until the transaction is applied
+    (new ones, and ones whose protocols change).
+    """
+    existing = set( lines( sh( 'ovs-vsctl', 'list-br' ) ) )
+    vsctl = []
+    ipcmds = []
+    pending = set()
+
+    for name in spec.get( 'absent', [] ):
+        if name in existing:
+            vsctl.append( [ 'del-br', name ] )
+
+    for name, want in sorted( spec.get( 'bridges', {} ).items() ):
+        if name in existing:
+            have = currentBridge( name )
+        else:
+            vsctl.append( [ 'add-br', name ] )
+            pending.add( name )
+            have = dict( ports=[], ip=[], controller=[], protocols=[] )
+
+        if 'ports' in want:
+            for port in want[ 'ports' ]:
+                if port not in have[ 'ports' ]:
+                    vsctl.append( [ '--may-exist', 'add-port', name, port ] )
+            for port in have[ 'ports' ]:
+                if port not in want[ 'ports' ]:
+                    vsctl.append( [ 'del-port', name, port ] )
+
+        if 'protocols' in want and set( want[ 'protocols' ] ) != set( have[ 'protocols' ] ):
+            vsctl.append( [ 'set', 'bridge', name,
+                            'protocols=' + ','.join( want[ 'protocols' ] ) ] )
+            pending.add( name )
+
+        controllers = want.get( 'controller' )
+        if controllers is not None and set( controllers ) != set( have[ 'controller' ] ):
+            if controllers:
+                vsctl.append( [ 'set-controller', name ] + controllers )
+            else:
+                vsctl.append( [ 'del-controller', name ] )
+
+        addrs = want.get( 'ip' )
+        if isinstance( addrs, str ):
+            addrs = [ addrs ]
+        if addrs is not None:
+            for addr in addrs:
+                if addr not in have[ 'ip' ]:
+                    ipcmds.append( [ 'ip', 'addr', 'add', addr, 'dev', name ] )
+            for addr in have[ 'ip' ]:
+                if addr not in addrs:
+                    ipcmds.append( [ 'ip', 'addr', 'del', addr, 'dev', name ] )
+        ipcmds.append( [ 'ip', 'link', 'set', name, 'up' ] )
+
+    flows = dict( ( name, want[ 'flows' ] )
+                  for name, want in spec.get( 'bridges', {} ).items()
+                  if want.get( 'flows' ) is not None )
+    return vsctl, ipcmds, flows, pending
+
+def syncFlows( name, flows, dryRun ):
+    "Replace the flows on bridge name if they differ from flows"
+    with tempfile.NamedTemporaryFile( 'w', suffix='.flows' ) as f:
+        f.write( '\n'.join( flows ) + '\n' )
+        f.flush()
+        # diff-flows exits 0 if the flows match and 2 if they differ
+        proc = subprocess.run( [ 'ovs-ofctl', '-O', BUNDLE_PROTOCOL,
+                                 'diff-flows', name, f.name ],
+                               stdout=subprocess.PIPE, universal_newlines=True )
+        if proc.returncode == 0:
+            return False
+        if proc.returncode != 2:
+            raise subprocess.CalledProcessError( proc.returncode, proc.args,
+                                                 proc.stdout )
+        diff = proc.stdout
+        print( 'Flows on %s:\n%s' % ( name, diff ) )
+        if not dryRun:
+            sh( 'ovs-ofctl', '--bundle', 'replace-flows', name, f.name )
+    return True
+
+def provision( spec, dryRun=False ):
+    "Apply spec; returns True if anything changed"
+    vsctl, ipcmds, flows, pending = plan( spec )
+    changed = bool( vsctl )
+
+    if vsctl:
+        cmd = [ 'ovs-vsctl' ]
+        for c in vsctl:
+            cmd += [ '--' ] + c
+        print( ' '.join( cmd ) )
+        if not dryRun:
+            sh( *cmd )
+
+    for cmd in ipcmds:
+        if cmd[ 1 ] == 'addr':
+            changed = True
+            print( ' '.join( cmd ) )
+        if not dryRun:
+            sh( *cmd )
+
+    for name in sorted( flows ):
+        if dryRun and name in pending:
+            # Not there yet, or can't speak OpenFlow14 until it's applied
+            print( 'Flows on %s: %d to sync' % ( name, len( flows[ name ] ) ) )
+            changed = True
+            continue
+        changed = syncFlows( name, flows[ name ], dryRun ) or changed
+    return changed
+
+def main():
+    parser = argparse.ArgumentParser( description=__doc__.split( '\n\n' )[ 0 ] )
+    parser.add_argument( 'spec', help='JSON switch spec' )
+    parser.add_argument( '-n', '--dry-run', action='store_true',
+                         help='print the changes without applying them' )
+    args = parser.parse_args()
+
+    with open( args.spec ) as f:
+        spec = json.load( f )
+    if not provision( spec, args.dry_run ):
+        print( 'Already up to date' )
+
+if __name__ == '__main__':
+    sys.exit( main() )
@@ -0,0 +1,99 @@
+import unittest
+
+from nat_allocator import (Ipv4_addr, PortBlockAllocator, CLOSING_TIMEOUT,
+                           IDLE_TIMEOUTS, TCP_ACK, TCP_FIN, TCP_RST, TCP_SYN)
+
+TCP = 6
+UDP = 17
+
+
+class PortBlockAllocatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.nat = PortBlockAllocator(["1.1.1.1", "2.2.2.2"],
+                                      range(50000, 50256), 64)
+
+    def test_translation_is_stable_and_reversible(self):
+        addr = Ipv4_addr("192.168.0.5", 1234)
+        ex = self.nat.translate(TCP, addr, now=0)
+        self.assertEqual(ex, ("1.1.1.1", 50000))
+        self.assertEqual(self.nat.translate(TCP, addr, now=1), ex)
+        self.assertEqual(self.nat.lookup(ex[0], TCP, ex[1], now=2), addr)
+        self.assertIsNone(self.nat.lookup(ex[0], UDP, ex[1], now=2))
+
+    def test_protocols_use_ports_independently(self):
+        tcp = self.nat.translate(TCP, Ipv4_addr("192.168.0.5", 1), now=0)
+        udp = self.nat.translate(UDP, Ipv4_addr("192.168.0.5", 2), now=0)
+        self.assertEqual(tcp, udp)
+        self.assertEqual(self.nat.lookup(udp[0], UDP, udp[1], now=0),
+                         Ipv4_addr("192.168.0.5", 2))
+
+    def test_new_hosts_rotate_over_the_pool(self):
+        a = self.nat.translate(TCP, Ipv4_addr("192.168.0.5", 1), now=0)
+        b = self.nat.translate(TCP, Ipv4_addr("192.168.0.6", 1), now=0)
+        self.assertEqual((a[0], b[0]), ("1.1.1.1", "2.2.2.2"))
+
+    def test_host_stays_on_its_address(self):
+        ex = [self.nat.translate(TCP, Ipv4_addr("192.168.0.5", p), now=0)
+              for p in range(130)]
+        self.assertEqual(set(ip for ip, _ in ex), {"1.1.1.1"})
+        self.assertEqual(len(self.nat.hosts["192.168.0.5"]["blocks"]), 3)
+
+    def test_exhaustion_returns_none(self):
+        nat = PortBlockAllocator(["1.1.1.1"], range(50000, 50128), 64)
+        self.assertIsNotNone(nat.translate(TCP, Ipv4_addr("10.0.0.1", 1), now=0))
+        self.assertIsNotNone(nat.translate(TCP, Ipv4_addr("10.0.0.2", 1), now=0))
+        self.assertIsNone(nat.translate(TCP, Ipv4_addr("10.0.0.3", 1), now=0))
+        self.assertNotIn("10.0.0.3", nat.hosts)
+
+    def test_idle_expiry_returns_block_to_pool(self):
+        addr = Ipv4_addr("192.168.0.5", 1)
+        ex = self.nat.translate(UDP, addr, now=0)
+        self.assertEqual(self.nat.expire(now=IDLE_TIMEOUTS[UDP] - 1), 0)
+        self.assertEqual(self.nat.expire(now=IDLE_TIMEOUTS[UDP]), 1)
+        self.assertIsNone(self.nat.lookup(ex[0], UDP, ex[1], now=0))
+        self.assertEqual(self.nat.hosts, {})
+        self.assertEqual(len(self.nat.free_blocks["1.1.1.1"]), 4)
+
+    def test_use_pushes_back_expiry(self):
+        addr = Ipv4_addr("192.168.0.5", 1)
+        ex = self.nat.translate(UDP, addr, now=0)
+        self.nat.lookup(ex[0], UDP, ex[1], now=50)
+        self.assertEqual(self.nat.expire(now=IDLE_TIMEOUTS[UDP]), 0)
+
+    def test_fin_and_rst_shorten_expiry(self):
+        fin = Ipv4_addr("192.168.0.5", 1)
+        rst = Ipv4_addr("192.168.0.5", 2)
+        self.nat.translate(TCP, fin, now=0)
+        self.nat.translate(TCP, fin, TCP_FIN | TCP_ACK, now=1)
+        self.nat.translate(TCP, fin, TCP_ACK, now=2)
+        self.nat.translate(TCP, rst, TCP_RST, now=1)
+        self.assertEqual(self.nat.expire(now=1), 1)
+        self.assertEqual(self.nat.expire(now=1 + CLOSING_TIMEOUT), 1)
+
+    def test_syn_revives_closing_translation(self):
+        addr = Ipv4_addr("192.168.0.5", 1)
+        ex = self.nat.translate(TCP, addr, TCP_RST, now=1)
+        self.assertEqual(self.nat.translate(TCP, addr, TCP_SYN, now=2), ex)
+        self.assertEqual(self.nat.expire(now=3), 0)
+        self.nat.translate(TCP, addr, TCP_ACK, now=4)
+        self.assertEqual(self.nat.expire(now=5 + CLOSING_TIMEOUT), 0)
+
+    def test_inbound_flags_do_not_close(self):
+        addr = Ipv4_addr("192.168.0.5", 1)
+        ex = self.nat.translate(TCP, addr, TCP_SYN, now=0)
+        self.nat.lookup(ex[0], TCP, ex[1], now=1)
+        self.assertEqual(self.nat.expire(now=2), 0)
+
+    def test_released_ports_are_reused_last(self):
+        a = Ipv4_addr("192.168.0.5", 1)
+        b = Ipv4_addr("192.168.0.5", 2)
+        ex_a = self.nat.translate(UDP, a, now=0)
+        self.nat.translate(UDP, b, now=100)
+        self.nat.expire(now=IDLE_TIMEOUTS[UDP])
+        c = self.nat.translate(UDP, Ipv4_addr("192.168.0.5", 3), now=61)
+        self.assertNotEqual(c, ex_a)
+
+
+if __name__ == "__main__":
+    unittest.main()
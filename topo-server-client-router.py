@@ -6,16 +6,24 @@ Network with Linux IP router
 Converts a Node into a router using IP forwarding
 already built into Linux.
 
-Topology creates a router and three IP subnets:
+Topology creates a router, N inside subnets and one outside subnet:
 
-    - 192.168.1.0/24 (r0-eth1, IP: 192.168.1.1)
-    - 172.16.0.0/12 (r0-eth2, IP: 172.16.0.1)
+    - 192.168.i.0/24 (r0-eth<i>, IP: 192.168.i.1) for i in 1..N
+    - 172.16.0.0/12 (r0-eth<N+1>, IP: 172.16.0.1)
 
-Each subnet consists of a single host connected to
-a single switch:
+Each inside subnet is a single switch with M client hosts, and
+the outside subnet is a single switch with K servers.  The
+defaults (N=1, M=2, K=1) give the original topology:
 
-    r0-eth1 - self.s1-eth1 - c1-eth0 (IP: 192.168.1.100)
-    r0-eth2 - self.s2-eth1 - h1-eth0 (IP: 172.16.0.100)
+    r0-eth1 - s1-eth1 - c1-eth0 (IP: 192.168.1.100)
+                      - c2-eth0 (IP: 192.168.1.101)
+    r0-eth2 - s2-eth1 - h1-eth0 (IP: 172.16.0.100)
+
+The firewall only treats 192.168.1.0/24 as inside by default, so
+with N > 1 the controller must be started with the inside network
+widened to cover every subnet, e.g.:
+
+    ./pox.py learningswitch --inside=192.168.0.0/16
 
 This relies on default routing entries that are
 automatically created for each router interface, as well
@@ -23,8 +31,31 @@ as 'defaultRoute' parameters for the host interfaces.
 
 Additional routes may be added to the router or hosts by
 executing 'ip route' or 'route' commands on the router or hosts.
+
+Run without arguments for the interactive CLI.  With --bench
+the scripted workloads below are run instead and a JSON report
+is written:
+
+    - ramp: connection-rate ramp from clients to servers,
+      recording TCP connection setup latency
+    - transfer: long-lived iperf transfers
+    - scan: inbound connection attempts from servers to clients,
+      which the firewall should drop.  Clients listen on the
+      server port during the scan so that it is among the
+      scanned ports, and the outcome of every attempt
+      (connected, refused or timeout) is reported.
+
+Controller CPU time and RSS (given --controller-pid) and the
+flow-table occupancy of every switch are sampled after each
+workload.
 """
 
+import argparse
+import json
+import os
+import tempfile
+import time
+
 from mininet.topo import Topo
 from mininet.net import Mininet
 from mininet.node import Node
@@ -32,6 +63,64 @@ from mininet.log import setLogLevel, info
 from mininet.cli import CLI
 from mininet.node import RemoteController
 
+SERVER_PORT = 8000
+
+# Paths of the helper scripts below once written out for the hosts
+CONNECT_PROBE_FILE = None
+ACCEPT_SERVER_FILE = None
+SCAN_PROBE_FILE = None
+
+# Run on a client: connect COUNT times to HOST:PORT at RATE per second
+# and print the setup latency of each attempt (None on failure).
+CONNECT_PROBE = """
+import json, socket, sys, time
+host, port, rate, count = sys.argv[1], int(sys.argv[2]), float(sys.argv[3]), int(sys.argv[4])
+lat = []
+for _ in range(count):
+    start = time.time()
+    s = socket.socket()
+    s.settimeout(2)
+    try:
+        s.connect((host, port))
+        lat.append(time.time() - start)
+    except OSError:
+        lat.append(None)
+    s.close()
+    time.sleep(max(0, 1.0 / rate - (time.time() - start)))
+print(json.dumps(lat))
+"""
+
+# Run on a server: try to connect to each of PORTS on HOST once and
+# print how each attempt went.
+SCAN_PROBE = """
+import json, socket, sys
+host, ports = sys.argv[1], [int(p) for p in sys.argv[2].split(',')]
+out = {}
+for port in ports:
+    s = socket.socket()
+    s.settimeout(2)
+    try:
+        s.connect((host, port))
+        out[port] = 'connected'
+    except ConnectionRefusedError:
+        out[port] = 'refused'
+    except OSError:
+        out[port] = 'timeout'
+    s.close()
+print(json.dumps(out))
+"""
+
+# Run on a server: accept and immediately close connections on PORT.
+ACCEPT_SERVER = """
+import socket, sys
+s = socket.socket()
+s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+s.bind(('', int(sys.argv[1])))
+s.listen(1024)
+while True:
+    s.accept()[0].close()
+"""
+
 class LinuxRouter( Node ):
     "A Node with IP forwarding enabled."
 
@@ -46,53 +135,243 @@ class LinuxRouter( Node ):
 
 
 class NetworkTopo( Topo ):
-    "A LinuxRouter connecting three IP subnets"
+    "A LinuxRouter connecting N inside subnets to one outside subnet"
 
-    def build( self, **_opts ):
+    def build( self, subnets=1, hosts=2, servers=1, **_opts ):
 
         defaultIP = '192.168.1.1/24'  # IP address for r0-eth1
-        
+
         # Add router
         router = self.addNode( 'r0', cls=LinuxRouter, ip=defaultIP )
 
-        # Add switches
-        self.s1 = self.addSwitch('s1')
-        self.s2 = self.addSwitch('s2')
+        self.clients = []
+        self.servers = []
 
-        # Add links
-        self.addLink( self.s1, router, intfName2='r0-eth1',
-                      params2={ 'ip' : defaultIP } )  # for clarity
-        self.addLink( self.s2, router, intfName2='r0-eth2',
+        # Inside subnets, one switch each
+        for i in range( 1, subnets + 1 ):
+            gw = '192.168.%d.1' % i
+            s = self.addSwitch( 's%d' % i )
+            self.addLink( s, router, intfName2='r0-eth%d' % i,
+                          params2={ 'ip' : gw + '/24' } )
+            for j in range( hosts ):
+                c = self.addHost( 'c%d' % ( len( self.clients ) + 1 ),
+                                  ip='192.168.%d.%d/24' % ( i, 100 + j ),
+                                  defaultRoute='via ' + gw )
+                self.clients.append( c )
+                self.addLink( c, s )
+
+        # Outside subnet
+        s = self.addSwitch( 's%d' % ( subnets + 1 ) )
+        self.addLink( s, router, intfName2='r0-eth%d' % ( subnets + 1 ),
                       params2={ 'ip' : '172.16.0.1/12' } )
+        for k in range( servers ):
+            h = self.addHost( 'h%d' % ( k + 1 ),
+                              ip='172.16.%d.%d/12' % ( k // 156, 100 + k % 156 ),
+                              defaultRoute='via 172.16.0.1' )
+            self.servers.append( h )
+            self.addLink( h, s )
 
-        # Add hosts
-        c1 = self.addHost( 'c1', ip='192.168.1.100/24',
-                           defaultRoute='via 192.168.1.1' )
-        c2 = self.addHost( 'c2', ip='192.168.1.101/24',
-                           defaultRoute='via 192.168.1.1' )
+def hostsNamed( net, names ):
+    "Hosts by name, looked up among the hosts only so controllers can't shadow them"
+    hosts = dict( ( h.name, h ) for h in net.hosts )
+    return [ hosts[ n ] for n in names ]
 
-        h1 = self.addHost( 'h1', ip='172.16.0.100/12',
-                           defaultRoute='via 172.16.0.1' )
+def controllerStats( pid ):
+    "CPU seconds and RSS bytes of the controller process, from /proc"
+    if pid is None:
+        return None
+    with open( '/proc/%d/stat' % pid ) as f:
+        fields = f.read().rsplit( ')', 1 )[ 1 ].split()
+    ticks = os.sysconf( 'SC_CLK_TCK' )
+    cpu = ( int( fields[ 11 ] ) + int( fields[ 12 ] ) ) / float( ticks )
+    rss = int( fields[ 21 ] ) * os.sysconf( 'SC_PAGE_SIZE' )
+    return { 'cpu_seconds': cpu, 'rss_bytes': rss }
 
-        # Wire the switches with hosts
-        for h, s in [ (c1, self.s1), (c2, self.s1), (h1, self.s2)]:
-            self.addLink( h, s )
+def flowCounts( net ):
+    "Number of installed flows on each switch"
+    counts = {}
+    for sw in net.switches:
+        out = sw.cmd( 'ovs-ofctl dump-aggregate %s' % sw.name )
+        counts[ sw.name ] = int( out.split( 'flow_count=' )[ 1 ].split()[ 0 ] )
+    return counts
+
+def sample( net, pid ):
+    return { 'time': time.time(), 'controller': controllerStats( pid ),
+             'flows': flowCounts( net ) }
+
+def summarize( latencies ):
+    ok = sorted( l for l in latencies if l is not None )
+    summary = { 'attempts': len( latencies ), 'failures': len( latencies ) - len( ok ) }
+    if ok:
+        summary.update( min=ok[ 0 ], max=ok[ -1 ],
+                        mean=sum( ok ) / len( ok ),
+                        p50=ok[ len( ok ) // 2 ],
+                        p99=ok[ min( len( ok ) - 1, int( len( ok ) * 0.99 ) ) ] )
+    return summary
+
+def probe( pairs, port, rate, count ):
+    "Run the connect probe from each source to its target, in parallel"
+    for src, dst in pairs:
+        src.sendCmd( 'python3 %s %s %d %f %d' % ( CONNECT_PROBE_FILE, dst.IP(),
+                                                   port, rate, count ) )
+    latencies = []
+    for src, _ in pairs:
+        latencies += json.loads( src.waitOutput().strip().splitlines()[ -1 ] )
+    return latencies
+
+def pairUp( sources, targets ):
+    "Spread sources round-robin over targets"
+    return [ ( s, targets[ n % len( targets ) ] ) for n, s in enumerate( sources ) ]
+
+def rampWorkload( net, topo, rates, count ):
+    clients = hostsNamed( net, topo.clients )
+    servers = hostsNamed( net, topo.servers )
+    steps = []
+    for rate in rates:
+        info( '*** Ramp: %s conn/s per client\n' % rate )
+        lat = probe( pairUp( clients, servers ), SERVER_PORT, rate, count )
+        steps.append( dict( rate=rate, latency=summarize( lat ) ) )
+    return steps
 
-def run():
+def transferWorkload( net, topo, duration ):
+    clients = hostsNamed( net, topo.clients )
+    servers = hostsNamed( net, topo.servers )
+    info( '*** Transfer: %ds iperf from each client\n' % duration )
+    for s in servers:
+        s.cmd( 'iperf -s -p 5001 &' )
+    for n, c in enumerate( clients ):
+        s = servers[ n % len( servers ) ]
+        c.sendCmd( 'iperf -y C -c %s -p 5001 -t %d' % ( s.IP(), duration ) )
+    results = []
+    for c in clients:
+        out = c.waitOutput().strip().splitlines()
+        # CSV; the last column is bits per second
+        bps = int( out[ -1 ].split( ',' )[ -1 ] ) if out else None
+        results.append( dict( client=c.name, bits_per_second=bps ) )
+    for s in servers:
+        s.cmd( 'kill %iperf' )
+    return results
+
+def scanWorkload( net, topo, ports ):
+    clients = hostsNamed( net, topo.clients )
+    servers = hostsNamed( net, topo.servers )
+    info( '*** Scan: %d ports on each client from outside\n' % len( ports ) )
+    for c in clients:
+        c.cmd( 'python3 %s %d &' % ( ACCEPT_SERVER_FILE, SERVER_PORT ) )
+    time.sleep( 1 )
+    # Each client is scanned by one server; a server takes turns
+    # when there are more clients than servers
+    results = {}
+    portList = ','.join( str( p ) for p in ports )
+    for n in range( 0, len( clients ), len( servers ) ):
+        pairs = list( zip( servers, clients[ n:n + len( servers ) ] ) )
+        for src, dst in pairs:
+            src.sendCmd( 'python3 %s %s %s' % ( SCAN_PROBE_FILE, dst.IP(), portList ) )
+        for src, dst in pairs:
+            results[ dst.name ] = json.loads( src.waitOutput().strip().splitlines()[ -1 ] )
+    for c in clients:
+        c.cmd( 'kill %python3' )
+    totals = {}
+    for outcomes in results.values():
+        for outcome in outcomes.values():
+            totals[ outcome ] = totals.get( outcome, 0 ) + 1
+    return dict( ports=list( ports ), totals=totals, clients=results )
+
+def bench( net, topo, args ):
+    "Run the scripted workloads and return the report"
+    if args.subnets > 1:
+        info( '*** %d inside subnets: the controller must be started with '
+              '--inside=192.168.0.0/16\n' % args.subnets )
+    servers = hostsNamed( net, topo.servers )
+    for s in servers:
+        s.cmd( 'python3 %s %d &' % ( ACCEPT_SERVER_FILE, SERVER_PORT ) )
+    time.sleep( 1 )
+
+    report = dict( topology=dict( subnets=args.subnets, hosts=args.hosts,
+                                  servers=args.servers ),
+                   samples=[ dict( workload='start', **sample( net, args.controller_pid ) ) ] )
+    report[ 'ramp' ] = rampWorkload( net, topo, args.rates, args.count )
+    report[ 'samples' ].append( dict( workload='ramp', **sample( net, args.controller_pid ) ) )
+    report[ 'transfer' ] = transferWorkload( net, topo, args.duration )
+    report[ 'samples' ].append( dict( workload='transfer', **sample( net, args.controller_pid ) ) )
+    ports = sorted( set( range( 1, args.scan_ports + 1 ) ) | { SERVER_PORT } )
+    report[ 'scan' ] = scanWorkload( net, topo, ports )
+    report[ 'samples' ].append( dict( workload='scan', **sample( net, args.controller_pid ) ) )
+
+    for s in servers:
+        s.cmd( 'kill %python3' )
+    return report
+
+def writeScript( source ):
+    fd, path = tempfile.mkstemp( suffix='.py' )
+    with os.fdopen( fd, 'w' ) as f:
+        f.write( source )
+    return path
+
+def run( args ):
     "Test linux router"
-    topo = NetworkTopo()
+    global CONNECT_PROBE_FILE, ACCEPT_SERVER_FILE, SCAN_PROBE_FILE
+    topo = NetworkTopo( subnets=args.subnets, hosts=args.hosts,
+                        servers=args.servers )
     net = Mininet( topo=topo)  # controller is used by self.s1-s3
 
     # Connect to remote controller
-    net.addController('c0', controller=RemoteController, ip='127.0.0.1', protocol='tcp', port=6633)
-    net.addController('c1')
+    # (named so they don't clash with the c<n> client hosts)
+    net.addController('ctl0', controller=RemoteController, ip='127.0.0.1', protocol='tcp', port=6633)
+    net.addController('ctl1')
     net.start()
 
     info( '*** Routing Table on Router:\n' )
     print(net[ 'r0' ].cmd( 'route' ))
-    CLI( net )
+    if args.bench is None:
+        CLI( net )
+    else:
+        CONNECT_PROBE_FILE = writeScript( CONNECT_PROBE )
+        ACCEPT_SERVER_FILE = writeScript( ACCEPT_SERVER )
+        SCAN_PROBE_FILE = writeScript( SCAN_PROBE )
+        try:
+            report = bench( net, topo, args )
+        finally:
+            os.unlink( CONNECT_PROBE_FILE )
+            os.unlink( ACCEPT_SERVER_FILE )
+            os.unlink( SCAN_PROBE_FILE )
+        with open( args.bench, 'w' ) as f:
+            json.dump( report, f, indent=2 )
+        info( '*** Report written to %s\n' % args.bench )
     net.stop()
 
+def parseArgs():
+    parser = argparse.ArgumentParser( description=__doc__.split( '\n\n' )[ 0 ] )
+    parser.add_argument( '--subnets', type=int, default=1,
+                         help='number of inside subnets (N)' )
+    parser.add_argument( '--hosts', type=int, default=2,
+                         help='client hosts per inside switch (M)' )
+    parser.add_argument( '--servers', type=int, default=1,
+                         help='outside servers (K)' )
+    parser.add_argument( '--bench', metavar='REPORT',
+                         help='run the workloads and write a JSON report' )
+    parser.add_argument( '--controller-pid', type=int,
+                         help='controller process to sample CPU/RSS from' )
+    parser.add_argument( '--rates', type=float, nargs='+',
+                         default=[ 1, 5, 10, 20, 50 ],
+                         help='connection rates per client for the ramp' )
+    parser.add_argument( '--count', type=int, default=20,
+                         help='connections per client at each ramp step' )
+    parser.add_argument( '--duration', type=int, default=10,
+                         help='seconds for each long-lived transfer' )
+    parser.add_argument( '--scan-ports', type=int, default=20,
+                         help='scan ports 1..N on each client, as well as '
+                              'the server port' )
+    args = parser.parse_args()
+    # Inside hosts are 192.168.<subnet>.<100 + host>
+    if not 1 <= args.subnets <= 254:
+        parser.error( '--subnets must be between 1 and 254' )
+    if not 1 <= args.hosts <= 155:
+        parser.error( '--hosts must be between 1 and 155' )
+    if not 1 <= args.servers <= 156 * 256:
+        parser.error( '--servers must be between 1 and %d' % ( 156 * 256 ) )
+    return args
+
 if __name__ == '__main__':
     setLogLevel( 'info' )
-    run()
\ No newline at end of file
+    run( parseArgs() )